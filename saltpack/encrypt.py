@@ -1,14 +1,17 @@
 #! /usr/bin/env python3
 
 import binascii
+import concurrent.futures
+import functools
 import hashlib
 import hmac
 import io
+import itertools
 import json
 import os
 import sys
 
-import umsgpack
+import msgpack
 import nacl.bindings
 from nacl.exceptions import CryptoError
 
@@ -20,6 +23,13 @@ from .debug import debug, tohex
 # Utility functions.
 # ------------------
 
+def available_cpus():
+    'The number of CPUs this process is allowed to run on.'
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def chunks_with_empty(message, chunk_size):
     'The last chunk is empty, which signifies the end of the message.'
     chunk_start = 0
@@ -32,6 +42,26 @@ def chunks_with_empty(message, chunk_size):
     return chunks
 
 
+def msgpack_bin_header(length):
+    'The msgpack type and length prefix for a bin object of this length.'
+    if length < 2**8:
+        return b'\xc4' + length.to_bytes(1, 'big')
+    elif length < 2**16:
+        return b'\xc5' + length.to_bytes(2, 'big')
+    elif length < 2**32:
+        return b'\xc6' + length.to_bytes(4, 'big')
+    else:
+        raise ValueError('bin too long for msgpack: {}'.format(length))
+
+
+def bytes_unpacker(data):
+    '''A msgpack Unpacker over bytes that are already in memory. msgpack
+    refuses objects bigger than max_buffer_size, 100 MiB by default, so
+    allow anything up to the size of the input.'''
+    return msgpack.Unpacker(
+        io.BytesIO(data), raw=False, max_buffer_size=len(data))
+
+
 def json_repr(obj):
     # We need to repr everything that JSON doesn't directly support,
     # particularly bytes.
@@ -70,6 +100,11 @@ assert len(PAYLOAD_NONCE_PREFIX) == 16
 CURRENT_MAJOR_VERSION = 1
 CURRENT_MINOR_VERSION = 0
 
+# The two beforenm calls for a recipient take about 85 us, and starting and
+# joining a thread pool takes about 75 us for two workers (more with more
+# workers). Below this many recipients the pool doesn't pay for itself.
+THREADED_BEFORENM_MIN_RECIPIENTS = 4
+
 
 def payload_key_nonce(version, recipient_index):
     if version == 1:
@@ -79,28 +114,60 @@ def payload_key_nonce(version, recipient_index):
                 recipient_index.to_bytes(8, "big")
 
 
-def encrypt(sender_private, recipient_public_keys, message, chunk_size, *,
-            visible_recipients=False):
+def encrypt_stream(sender_private, recipient_public_keys, message_chunks, *,
+                   visible_recipients=False):
+    '''Generate the encrypted message in pieces, without holding the whole
+    message in memory. Each non-empty chunk of plaintext from message_chunks
+    becomes one payload packet, and the empty chunk that ends the message is
+    added here. Concatenating the yielded bytes gives the ciphertext.'''
     sender_public = nacl.bindings.crypto_scalarmult_base(sender_private)
-    ephemeral_private = os.urandom(32)
+    # Get both random keys from a single urandom call.
+    random_bytes = os.urandom(64)
+    ephemeral_private = random_bytes[:32]
+    payload_key = random_bytes[32:]
     ephemeral_public = nacl.bindings.crypto_scalarmult_base(ephemeral_private)
-    payload_key = os.urandom(32)
 
     sender_secretbox = nacl.bindings.crypto_secretbox(
         message=sender_public,
         nonce=SENDER_KEY_SECRETBOX_NONCE,
         key=payload_key)
 
+    # Do the Curve25519 key agreement with each recipient just once, up front.
+    # Every box we make for a recipient below reuses these shared keys. This
+    # is most of the per-recipient work, and libsodium releases the GIL while
+    # it runs, so with enough recipients spread it across threads.
+    def recipient_beforenms(recipient_public):
+        ephemeral_beforenm = nacl.bindings.crypto_box_beforenm(
+            pk=recipient_public,
+            sk=ephemeral_private)
+        sender_beforenm = nacl.bindings.crypto_box_beforenm(
+            pk=recipient_public,
+            sk=sender_private)
+        return ephemeral_beforenm, sender_beforenm
+
+    max_workers = min(len(recipient_public_keys), available_cpus())
+    if (len(recipient_public_keys) >= THREADED_BEFORENM_MIN_RECIPIENTS and
+            max_workers > 1):
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            beforenms = list(executor.map(recipient_beforenms,
+                                          recipient_public_keys))
+    else:
+        # With few recipients (one is the common case) or a single CPU,
+        # starting a thread pool costs more than it saves.
+        beforenms = [recipient_beforenms(recipient_public)
+                     for recipient_public in recipient_public_keys]
+    ephemeral_beforenms = [ephemeral for ephemeral, _ in beforenms]
+    sender_beforenms = [sender for _, sender in beforenms]
+
     recipient_pairs = []
     for i, recipient_public in enumerate(recipient_public_keys):
         # The recipient box holds the sender's long-term public key and the
         # symmetric message encryption key. It's encrypted for each recipient
         # with the ephemeral private key.
-        payload_key_box = nacl.bindings.crypto_box(
+        payload_key_box = nacl.bindings.crypto_box_afternm(
             message=payload_key,
             nonce=payload_key_nonce(CURRENT_MAJOR_VERSION, i),
-            pk=recipient_public,
-            sk=ephemeral_private)
+            k=ephemeral_beforenms[i])
         # None is for the recipient public key, which is optional.
         if visible_recipients:
             pair = [recipient_public, payload_key_box]
@@ -118,54 +185,86 @@ def encrypt(sender_private, recipient_public_keys, message, chunk_size, *,
         sender_secretbox,
         recipient_pairs,
     ]
-    header_bytes = umsgpack.packb(header)
-    header_hash = nacl.bindings.crypto_hash(header_bytes)
-    double_encoded_header_bytes = umsgpack.packb(header_bytes)
-    output = io.BytesIO()
-    output.write(double_encoded_header_bytes)
+    header_bytes = msgpack.packb(header, use_bin_type=True)
+    header_hash = hashlib.sha512(header_bytes).digest()
+    double_encoded_header_bytes = msgpack.packb(
+        header_bytes, use_bin_type=True)
+    yield double_encoded_header_bytes
 
     # Compute the per-user MAC keys.
     recipient_mac_keys = []
     mac_keys_nonce = header_hash[:24]
-    for recipient_public in recipient_public_keys:
-        mac_key_box = nacl.bindings.crypto_box(
+    for sender_beforenm in sender_beforenms:
+        mac_key_box = nacl.bindings.crypto_box_afternm(
             message=b'\0'*32,
             nonce=mac_keys_nonce,
-            pk=recipient_public,
-            sk=sender_private)
+            k=sender_beforenm)
         mac_key = mac_key_box[16:48]
         recipient_mac_keys.append(mac_key)
 
-    # Write the chunks.
-    for chunknum, chunk in enumerate(chunks_with_empty(message, chunk_size)):
+    # The MAC keys are the same for every chunk, so key each HMAC once (that
+    # hashes the ipad and opad blocks) and copy the keyed state per chunk.
+    recipient_hmacs = [hmac.new(mac_key, digestmod=hashlib.sha512)
+                       for mac_key in recipient_mac_keys]
+
+    # Every payload hash starts with the header hash. Feed it in once and
+    # copy the hash state for each chunk, rather than concatenating it onto
+    # every ciphertext.
+    payload_hash_base = hashlib.sha512(header_hash)
+
+    # Write the chunks. An empty chunk would end the message early, so skip
+    # those and add the terminating empty chunk ourselves.
+    chunks = itertools.chain(
+        (chunk for chunk in message_chunks if len(chunk) > 0), [b''])
+    for chunknum, chunk in enumerate(chunks):
         payload_nonce = PAYLOAD_NONCE_PREFIX + chunknum.to_bytes(8, "big")
         payload_secretbox = nacl.bindings.crypto_secretbox(
             message=chunk,
             nonce=payload_nonce,
             key=payload_key)
         # Authenticate the hash of the payload for each recipient.
-        payload_hash = nacl.bindings.crypto_hash(
-            header_hash + payload_nonce + payload_secretbox)
+        payload_hasher = payload_hash_base.copy()
+        payload_hasher.update(payload_nonce)
+        payload_hasher.update(payload_secretbox)
+        payload_hash = payload_hasher.digest()
         hash_authenticators = []
-        for mac_key in recipient_mac_keys:
-            hmac_digest = hmac.new(mac_key, digestmod=hashlib.sha512)
+        for recipient_hmac in recipient_hmacs:
+            hmac_digest = recipient_hmac.copy()
             hmac_digest.update(payload_hash)
             hash_authenticators.append(hmac_digest.digest()[:32])
-        packet = [
-            hash_authenticators,
-            payload_secretbox,
-        ]
-        output.write(umsgpack.packb(packet))
+        # Write the packet, [hash_authenticators, payload_secretbox], by
+        # hand. msgpack would copy the whole secretbox into a new bytes
+        # object just to prepend its length, so we yield the prefix and the
+        # secretbox separately.
+        yield (b'\x92' +  # fixarray of 2 elements
+               msgpack.packb(hash_authenticators, use_bin_type=True) +
+               msgpack_bin_header(len(payload_secretbox)))
+        yield payload_secretbox
 
-    return output.getvalue()
+
+def encrypt(sender_private, recipient_public_keys, message, chunk_size, *,
+            visible_recipients=False):
+    if chunk_size <= 0:
+        raise ValueError(
+            "Chunk size must be positive: {}".format(chunk_size))
+    # Slicing a memoryview doesn't copy, so the only copy of each chunk is
+    # the one crypto_secretbox makes.
+    message_view = memoryview(message)
+    message_chunks = (message_view[start:start+chunk_size]
+                      for start in range(0, len(message), chunk_size))
+    return b''.join(encrypt_stream(
+        sender_private,
+        recipient_public_keys,
+        message_chunks,
+        visible_recipients=visible_recipients))
 
 
 def decrypt(input, recipient_private):
-    stream = io.BytesIO(input)
+    unpacker = bytes_unpacker(input)
     # Parse the header.
-    header_bytes = umsgpack.unpack(stream)
-    header_hash = nacl.bindings.crypto_hash(header_bytes)
-    header = umsgpack.unpackb(header_bytes)
+    header_bytes = unpacker.unpack()
+    header_hash = hashlib.sha512(header_bytes).digest()
+    header = msgpack.unpackb(header_bytes, raw=False)
     debug('header:', json_repr(header))
     debug('header hash:', header_hash)
     [
@@ -221,52 +320,57 @@ def decrypt(input, recipient_private):
     else:
         mac_key_nonce_base = bytearray(header_hash[:16])
         mac_key_nonce_base[15] &= 254  # clear the last bit
+        sender_nonce_base = bytes(mac_key_nonce_base)
+        mac_key_nonce_base[15] |= 1  # set the last bit
+        ephemeral_nonce_base = bytes(mac_key_nonce_base)
+        recipient_index_bytes = recipient_index.to_bytes(8, "big")
         mac_key_box_sender = nacl.bindings.crypto_box(
             message=b'\0'*32,
-            nonce=bytes(mac_key_nonce_base) +
-                    recipient_index.to_bytes(8, "big"),
+            nonce=sender_nonce_base + recipient_index_bytes,
             pk=sender_public,
             sk=recipient_private)
-        mac_key_nonce_base[15] |= 1  # set the last bit
-        mac_key_box_ephemeral = nacl.bindings.crypto_box(
+        mac_key_box_ephemeral = nacl.bindings.crypto_box_afternm(
             message=b'\0'*32,
-            nonce=bytes(mac_key_nonce_base) +
-                    recipient_index.to_bytes(8, "big"),
-            pk=ephemeral_public,
-            sk=recipient_private)
-        mac_key = nacl.bindings.crypto_hash(
-                mac_key_box_sender[-32:] + mac_key_box_ephemeral[-32:]
-                )[:32]
+            nonce=ephemeral_nonce_base + recipient_index_bytes,
+            k=ephemeral_beforenm)
+        mac_key_hasher = hashlib.sha512(mac_key_box_sender[-32:])
+        mac_key_hasher.update(mac_key_box_ephemeral[-32:])
+        mac_key = mac_key_hasher.digest()[:32]
 
     debug('recipient index:', recipient_index)
     debug('sender key:', sender_public)
     debug('payload key:', payload_key)
     debug('mac key:', mac_key)
+    keyed_hmac = hmac.new(mac_key, digestmod=hashlib.sha512)
+    # As in encrypt_stream, every payload hash starts with the header hash.
+    payload_hash_base = hashlib.sha512(header_hash)
 
     # Decrypt each of the packets.
     output = io.BytesIO()
     chunknum = 0
     while True:
-        packet = umsgpack.unpack(stream)
+        packet = unpacker.unpack()
         debug('packet:', json_repr(packet))
-        final_flag = False
+        # Only v2 packets have a final flag, and only v2 hashes it.
         if major_version == 1:
             [hash_authenticators, payload_secretbox, *_] = packet
+            final_flag = False
+            final_flag_byte = b""
         else:
             [final_flag, hash_authenticators, payload_secretbox, *_] = packet
+            final_flag_byte = b"\x01" if final_flag else b"\x00"
         hash_authenticator = hash_authenticators[recipient_index]
 
         # Verify the secretbox hash.
         payload_nonce = PAYLOAD_NONCE_PREFIX + chunknum.to_bytes(8, "big")
         debug('payload nonce:', payload_nonce)
-        if major_version == 1:
-            final_flag_byte = b""
-        else:
-            final_flag_byte = b"\x01" if final_flag else b"\x00"
-        payload_hash = nacl.bindings.crypto_hash(
-            header_hash + payload_nonce + final_flag_byte + payload_secretbox)
+        payload_hasher = payload_hash_base.copy()
+        payload_hasher.update(payload_nonce)
+        payload_hasher.update(final_flag_byte)
+        payload_hasher.update(payload_secretbox)
+        payload_hash = payload_hasher.digest()
         debug('hash to authenticate:', payload_hash)
-        hmac_digest = hmac.new(mac_key, digestmod=hashlib.sha512)
+        hmac_digest = keyed_hmac.copy()
         hmac_digest.update(payload_hash)
         our_authenticator = hmac_digest.digest()[:32]
         if not hmac.compare_digest(hash_authenticator, our_authenticator):
@@ -317,26 +421,39 @@ def get_recipients(args):
 def do_encrypt(args):
     message = args['--message']
     visible_recipients = args['--visible']
-    if message is None:
-        encoded_message = sys.stdin.buffer.read()
-    else:
-        encoded_message = message.encode('utf8')
-    sender = get_private(args)
     if args['--chunk']:
         chunk_size = int(args['--chunk'])
     else:
         chunk_size = 10**6
+    if chunk_size <= 0:
+        # read(0) returns b'', which would look like the end of stdin and
+        # silently encrypt an empty message.
+        raise ValueError(
+            "Chunk size must be positive: {}".format(chunk_size))
+    if message is None:
+        # Read stdin one chunk at a time, so that in binary mode we never hold
+        # more than a chunk of the message in memory.
+        message_chunks = iter(
+            functools.partial(sys.stdin.buffer.read, chunk_size), b'')
+    else:
+        encoded_message = message.encode('utf8')
+        message_chunks = chunks_with_empty(encoded_message, chunk_size)
+    sender = get_private(args)
     recipients = get_recipients(args)
-    output = encrypt(
+    output_pieces = encrypt_stream(
         sender,
         recipients,
-        encoded_message,
-        chunk_size,
+        message_chunks,
         visible_recipients=visible_recipients)
-    if not args['--binary']:
+    if args['--binary']:
+        for piece in output_pieces:
+            sys.stdout.buffer.write(piece)
+    else:
+        # Armoring needs the whole ciphertext at once.
+        output = b''.join(output_pieces)
         output = (armor.armor(output, message_type="ENCRYPTED MESSAGE") +
                   '\n').encode()
-    sys.stdout.buffer.write(output)
+        sys.stdout.buffer.write(output)
 
 
 def do_decrypt(args):
@@ -5,12 +5,12 @@ import hashlib
 import io
 import os
 import sys
-import umsgpack
+import msgpack
 
 import nacl.bindings
 
 from .debug import debug
-from .encrypt import json_repr, chunks_with_empty
+from .encrypt import json_repr, chunks_with_empty, bytes_unpacker
 from . import armor
 from . import error
 
@@ -24,16 +24,16 @@ def write_header(public_key, mode, output):
         public_key,
         nonce,
     ]
-    header_bytes = umsgpack.packb(header)
+    header_bytes = msgpack.packb(header, use_bin_type=True)
     header_hash = hashlib.sha512(header_bytes).digest()
-    umsgpack.pack(header_bytes, output)
+    output.write(msgpack.packb(header_bytes, use_bin_type=True))
     return header_hash
 
 
-def read_header(stream):
-    header_bytes = umsgpack.unpack(stream)
+def read_header(unpacker):
+    header_bytes = unpacker.unpack()
     header_hash = hashlib.sha512(header_bytes).digest()
-    header = umsgpack.unpackb(header_bytes)
+    header = msgpack.unpackb(header_bytes, raw=False)
     debug("header packet:", json_repr(header))
     debug("header hash:", json_repr(header_hash))
     [
@@ -70,7 +70,7 @@ def sign_attached(message, private_key, chunk_size):
             detached_payload_sig,
             chunk,
         ]
-        umsgpack.pack(packet, output)
+        output.write(msgpack.packb(packet, use_bin_type=True))
         packetnum += 1
 
     return output.getvalue()
@@ -84,18 +84,18 @@ def sign_detached(message, private_key):
     message_sig_text = b"saltpack detached signature\0" + message_digest
     message_sig = nacl.bindings.crypto_sign(message_sig_text, private_key)
     detached_message_sig = message_sig[:64]
-    umsgpack.pack(detached_message_sig, output)
+    output.write(msgpack.packb(detached_message_sig, use_bin_type=True))
     return output.getvalue()
 
 
 def verify_attached(message):
-    input = io.BytesIO(message)
+    unpacker = bytes_unpacker(message)
     output = io.BytesIO()
-    public_key, header_hash = read_header(input)
+    public_key, header_hash = read_header(unpacker)
 
     packetnum = 0
     while True:
-        payload_packet = umsgpack.unpack(input)
+        payload_packet = unpacker.unpack()
         debug("payload packet:", json_repr(payload_packet))
         [detached_payload_sig, chunk, *_] = payload_packet
         packetnum_64 = packetnum.to_bytes(8, 'big')
@@ -116,10 +116,10 @@ def verify_attached(message):
 
 
 def verify_detached(message, signature):
-    input = io.BytesIO(signature)
-    public_key, header_hash = read_header(input)
+    unpacker = bytes_unpacker(signature)
+    public_key, header_hash = read_header(unpacker)
 
-    detached_message_sig = umsgpack.unpack(input)
+    detached_message_sig = unpacker.unpack()
     debug("sig:", detached_message_sig)
     message_digest = hashlib.sha512(header_hash + message).digest()
     debug("digest:", message_digest)
@@ -17,7 +17,8 @@ setuptools.setup(
     url="https://github.com/keybase/saltpack-python",
     packages=['saltpack'],
     package_data={'saltpack': ['VERSION', 'unicode/*']},
-    install_requires=['docopt', 'pynacl', 'u-msgpack-python'],
+    python_requires='>=3.5',
+    install_requires=['docopt', 'msgpack>=1.0', 'pynacl'],
     entry_points={
         'console_scripts': [
             'saltpack=saltpack.main:main',
@@ -2,9 +2,12 @@
 # coding=utf8
 
 import binascii
+import os
 import re
 import tempfile
 from duct import cmd, sh
+import msgpack
+import nacl.bindings
 import pytest
 
 import saltpack
@@ -61,6 +64,54 @@ def test_encryption():
     assert message == decrypted, repr(message) + " != " + repr(decrypted)
 
 
+def test_encryption_binary_chunks():
+    # Binary mode streams stdin through encrypt_stream in chunk-sized reads.
+    encrypted = sh("python -m saltpack encrypt --binary --chunk=3") \
+        .input(inputstr.encode()) \
+        .stdout_capture() \
+        .run() \
+        .stdout
+    decrypted = sh("python -m saltpack decrypt --binary") \
+        .input(encrypted) \
+        .read()
+    assert inputstr == decrypted
+
+
+STREAM_PRIVATE = b'\x02' * 32
+STREAM_PUBLIC = nacl.bindings.crypto_scalarmult_base(STREAM_PRIVATE)
+
+
+def test_encrypt_stream_skips_empty_chunks():
+    # An empty chunk in the middle must not end the message early.
+    ciphertext = b''.join(saltpack.encrypt.encrypt_stream(
+        STREAM_PRIVATE, [STREAM_PUBLIC], [b'ab', b'', b'cd']))
+    assert saltpack.encrypt.decrypt(ciphertext, STREAM_PRIVATE) == b'abcd'
+
+
+def test_encrypt_stream_empty_message():
+    ciphertext = b''.join(saltpack.encrypt.encrypt_stream(
+        STREAM_PRIVATE, [STREAM_PUBLIC], []))
+    assert saltpack.encrypt.decrypt(ciphertext, STREAM_PRIVATE) == b''
+    ciphertext = saltpack.encrypt.encrypt(
+        STREAM_PRIVATE, [STREAM_PUBLIC], b'', 10)
+    assert saltpack.encrypt.decrypt(ciphertext, STREAM_PRIVATE) == b''
+
+
+def test_encrypt_stream_matches_encrypt(monkeypatch):
+    # Fix the random keys so that both calls produce the same ciphertext.
+    monkeypatch.setattr(os, 'urandom', lambda n: b'\x03' * n)
+    streamed = b''.join(saltpack.encrypt.encrypt_stream(
+        STREAM_PRIVATE, [STREAM_PUBLIC], [b'foo', b' ba', b'r']))
+    encrypted = saltpack.encrypt.encrypt(
+        STREAM_PRIVATE, [STREAM_PUBLIC], b'foo bar', 3)
+    assert streamed == encrypted
+
+
+def test_encrypt_bad_chunk_size():
+    with pytest.raises(ValueError):
+        saltpack.encrypt.encrypt(b'\0'*32, [], b'foo', 0)
+
+
 keybase_test_ciphertext = """\
 BEGIN KEYBASE SALTPACK ENCRYPTED MESSAGE. kiPgBwdlv6bV9N8 dSkCbjKrku2KOWE
 CKyuTXpSz8eiQEL e3MQnnUPheUrja0 Y8Fup2Sq6nJpfDJ DUH4yLqN5VvQAZv 6LiCR5GtOcL0hmT
@@ -122,6 +173,58 @@ def test_decrypt_HMAC_failure():
             binascii.unhexlify(keybase_test_secret_key))
 
 
+# A v2 message for two recipients, split into three chunks. The key below is
+# the second recipient's, so the recipient index is 1.
+v2_test_ciphertext = """\
+BEGIN SALTPACK ENCRYPTED MESSAGE. kfIwgFPlzTTT0Og Kbn8MXC3a5VGpNu
+XdeCZgkYwmLovA6 782kmUqpqMwuktu tBFhMWbD44KsBC5 UeCfXSpWwGQtjGF sx9y74udmuLVl9O
+HqM6dzTY0C7VGwD 5mAhAk0unnHOh6c XOrlM5nxfA62UsU nPCB8evfSdSY1pF hl9lKKgNihNGUFe
+78t75o0WYqUrmmN SbHmITQmd8YYXJ7 4n4FoAMEfr4kWnn aYwAYQXp3o1WDEr ZOiy4twYmAkRrba
+mTkDhRKQ0d6m5K3 3e1zUtDokxR9LFg ij6gh54PZ0QBELN S2pYHMoyUbyiFmQ tHrsA1z4WKBsIKu
+1f8oB1qQRzMyefL eceMyZqxD7pQ0hn hvJyoAQ8vTmTUh9 iYK42y8mw69xeX1 fnAivHqVGa8GzJP
+ZvS0eM5tBouV7TH 8TNv8e1fR0VvLsh rTQgyyGHgXxZ0r5 Ag4ZbGeXjkMhEjw SQdZoEUHdZaF7OJ
+hsgLNZc9FiPMNGg o3oVP4NywZiSuID ngAcKUjCnXUBRQc 7YKQnk18yn98iqv iFch8mTJEO8Hv1E
+c0UwM559vbFDavG UxhWoxmuHvAaeFx R5Rq1ifGdf3bliI Kl9Uv3blrvFSFgK fd4QY9SpUM27l42
+RuMwj4pouxz329S 5fljblRd4OBVu0k V6TAcK4. END SALTPACK ENCRYPTED MESSAGE.
+"""
+
+v2_test_plaintext = "real saltpack v2 message"
+
+v2_test_secret_key = \
+    "7a9afe251948996c163ab63b9f3cc17233a7b669d4235a250bee0222f5b2ce79"
+
+
+def test_decrypt_v2_message():
+    decrypted = cmd("python", "-m", "saltpack", "decrypt",
+                    v2_test_secret_key) \
+        .input(v2_test_ciphertext) \
+        .read()
+    assert decrypted == v2_test_plaintext
+
+
+# The same v2 ciphertext, with the last payload byte changed.
+v2_test_ciphertext_corrupt = """\
+BEGIN SALTPACK ENCRYPTED MESSAGE. kfIwgFPlzTTT0Og Kbn8MXC3a5VGpNu
+XdeCZgkYwmLovA6 782kmUqpqMwuktu tBFhMWbD44KsBC5 UeCfXSpWwGQtjGF sx9y74udmuLVl9O
+HqM6dzTY0C7VGwD 5mAhAk0unnHOh6c XOrlM5nxfA62UsU nPCB8evfSdSY1pF hl9lKKgNihNGUFe
+78t75o0WYqUrmmN SbHmITQmd8YYXJ7 4n4FoAMEfr4kWnn aYwAYQXp3o1WDEr ZOiy4twYmAkRrba
+mTkDhRKQ0d6m5K3 3e1zUtDokxR9LFg ij6gh54PZ0QBELN S2pYHMoyUbyiFmQ tHrsA1z4WKBsIKu
+1f8oB1qQRzMyefL eceMyZqxD7pQ0hn hvJyoAQ8vTmTUh9 iYK42y8mw69xeX1 fnAivHqVGa8GzJP
+ZvS0eM5tBouV7TH 8TNv8e1fR0VvLsh rTQgyyGHgXxZ0r5 Ag4ZbGeXjkMhEjw SQdZoEUHdZaF7OJ
+hsgLNZc9FiPMNGg o3oVP4NywZiSuID ngAcKUjCnXUBRQc 7YKQnk18yn98iqv iFch8mTJEO8Hv1E
+c0UwM559vbFDavG UxhWoxmuHvAaeFx R5Rq1ifGdf3bliI Kl9Uv3blrvFSFgK fd4QY9SpUM27l42
+RuMwj4pouxz329S 5fljblRd4OBVu0k V6TAcK5. END SALTPACK ENCRYPTED MESSAGE.
+"""
+
+
+def test_decrypt_v2_HMAC_failure():
+    ciphertext_binary = saltpack.armor.dearmor(v2_test_ciphertext_corrupt)
+    with pytest.raises(saltpack.error.HMACError):
+        saltpack.encrypt.decrypt(
+            ciphertext_binary,
+            binascii.unhexlify(v2_test_secret_key))
+
+
 bad_format_message = (
     #    badness here ↓
     b'\xc4\x97\x96\xa8XXXXpack\x92\x01\x00\x00\xc4 \xf6\xa9\x9e\xe2\xac7\x8c.B'
@@ -160,6 +263,13 @@ def test_decrypt_bad_version():
         saltpack.encrypt.decrypt(bad_version_message, b'\0'*32)
 
 
+def test_bytes_unpacker_big_bin():
+    # Bigger than msgpack's default max_buffer_size of 100 MiB.
+    big = bytes(101 * 2**20)
+    packed = msgpack.packb(big, use_bin_type=True)
+    assert saltpack.encrypt.bytes_unpacker(packed).unpack() == big
+
+
 def test_sign_attached():
     signed = sh("python -m saltpack sign").input(message).read()
     print(signed)